@@ -1,6 +1,6 @@
 import os
-import math
 import json
+import functools
 import subprocess
 import threading
 import time
@@ -22,6 +22,23 @@ from datetime import datetime
 import base64
 import uuid
 import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+from urllib.parse import quote
+
+try:
+    import orjson
+except ImportError:  # fall back to Flask's stdlib json
+    orjson = None
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers.inotify import InotifyObserver
+except ImportError:  # watchdog missing or no inotify on this platform
+    FileSystemEventHandler = object
+    InotifyObserver = None
 
 app = Flask(__name__)
 
@@ -45,10 +62,43 @@ class AppConfig:
         self.max_concurrent_transcodes = int(
             os.environ.get("MAX_CONCURRENT_TRANSCODES", "3")
         )
+        # Video encoder: "auto" (first working hardware encoder), "none"/"libx264",
+        # or an explicit encoder name such as "h264_nvenc"
+        self.hw_encoder = os.environ.get("HW_ENCODER", "auto").strip().lower()
+        self.vaapi_device = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+        # Skip zero-byte recordings/thumbnails in the tree (costs a stat per file)
+        self.validate_sizes = os.environ.get("VALIDATE_SIZES", "").lower() in (
+            "1",
+            "true",
+            "yes",
+        )
+        # Proxy offload, set by the deployment (never taken from request headers):
+        # ACCEL_MAPPING="/recordings/=/internal/recordings/,..." enables nginx
+        # X-Accel-Redirect; SENDFILE_HEADER="X-Sendfile" enables Apache/lighttpd
+        self.accel_mapping = []
+        for pair in os.environ.get("ACCEL_MAPPING", "").split(","):
+            fs_prefix, _, uri_prefix = pair.strip().partition("=")
+            if fs_prefix and uri_prefix:
+                self.accel_mapping.append(
+                    (os.path.realpath(fs_prefix), uri_prefix.rstrip("/"))
+                )
+        self.sendfile_header = os.environ.get("SENDFILE_HEADER", "").strip()
+        # Browser cache lifetime for recordings that are no longer being written;
+        # recent files are sent no-cache and revalidated by ETag
+        self.send_file_max_age = int(os.environ.get("SEND_FILE_MAX_AGE", "3600"))
+        # Finished HLS renditions kept on disk for repeat plays
+        self.hls_cache_entries = int(os.environ.get("HLS_CACHE_ENTRIES", "20"))
+        self.hls_cache_max_bytes = (
+            int(os.environ.get("HLS_CACHE_MAX_MB", "2048")) * 1024 * 1024
+        )
 
 
 class TranscodeState:
-    """Thread-safe tracker for active transcodes."""
+    """Thread-safe tracker for active transcodes.
+
+    Slots are reserved with a single check-and-increment so concurrent requests
+    cannot overshoot the limit; reads are lock-free snapshots of one int.
+    """
 
     def __init__(self, max_concurrent: int):
         self.max_concurrent = max_concurrent
@@ -56,44 +106,359 @@ class TranscodeState:
         self._lock = threading.Lock()
 
     def can_start(self) -> bool:
-        with self._lock:
-            return self.active_transcodes < self.max_concurrent
+        """Cheap pre-check; use try_acquire() to actually claim a slot."""
+        return self.active_transcodes < self.max_concurrent
 
-    def increment(self) -> None:
+    def try_acquire(self) -> bool:
         with self._lock:
+            if self.active_transcodes >= self.max_concurrent:
+                return False
             self.active_transcodes += 1
+            return True
 
-    def decrement(self) -> None:
+    def release(self) -> None:
         with self._lock:
             self.active_transcodes -= 1
 
     def snapshot(self) -> dict:
-        with self._lock:
-            return {
-                "active_transcodes": self.active_transcodes,
-                "max_concurrent": self.max_concurrent,
-                "available_slots": self.max_concurrent - self.active_transcodes,
-            }
+        active = self.active_transcodes
+        return {
+            "active_transcodes": active,
+            "max_concurrent": self.max_concurrent,
+            "available_slots": self.max_concurrent - active,
+        }
 
 
 class HlsJobRegistry:
-    """Thread-safe registry of HLS jobs for lifecycle management."""
+    """Thread-safe registry of HLS jobs for lifecycle management.
+
+    Jobs are also indexed by input so concurrent plays of the same recording
+    share one ffmpeg process; each play holds a reference on the job.
+    """
 
     def __init__(self):
         self._jobs = {}
+        self._by_input = {}
         self._lock = threading.Lock()
 
-    def register(self, job_id: str, proc: subprocess.Popen, job_dir: str) -> None:
+    @staticmethod
+    def _is_live(job: dict) -> bool:
+        proc = job["proc"]
+        if proc is None:  # reserved, ffmpeg still being spawned
+            return True
+        return proc.poll() is None and os.path.isdir(job["dir"])
+
+    def reserve(self, input_key, job_id: str, job_dir: str):
+        """Return the id of a live job for input_key, taking a reference on it.
+
+        Otherwise reserve job_id for input_key and return None.
+        """
         with self._lock:
-            self._jobs[job_id] = {"proc": proc, "dir": job_dir}
+            existing_id = self._by_input.get(input_key)
+            job = self._jobs.get(existing_id)
+            if job and self._is_live(job):
+                job["refs"] += 1
+                return existing_id
+            self._jobs[job_id] = {
+                "proc": None,
+                "dir": job_dir,
+                "input": input_key,
+                "refs": 1,
+                "ready": threading.Event(),
+            }
+            self._by_input[input_key] = job_id
+            return None
 
-    def pop(self, job_id: str):
+    def attach(self, job_id: str, proc: subprocess.Popen) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job["proc"] = proc
+                job["ready"].set()
+
+    def wait_started(self, job_id: str, timeout: float) -> bool:
+        """Wait for a reserved job's ffmpeg to be attached.
+
+        Returns False if the job was dropped before it started or is still
+        being spawned when the timeout expires.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if not job:
+            return False
+        job["ready"].wait(timeout)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return bool(job and job["proc"] is not None)
+
+    def _pop_locked(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job:
+            job["ready"].set()  # wake joiners waiting on a job that never started
+            if self._by_input.get(job["input"]) == job_id:
+                del self._by_input[job["input"]]
+        return job
+
+    def release(self, job_id: str):
+        """Drop one reference; return the job once no viewers remain, else None."""
         with self._lock:
-            return self._jobs.pop(job_id, None)
+            job = self._jobs.get(job_id)
+            if not job:
+                return None
+            job["refs"] -= 1
+            if job["refs"] > 0:
+                return None
+            return self._pop_locked(job_id)
 
     def remove(self, job_id: str) -> None:
         with self._lock:
-            self._jobs.pop(job_id, None)
+            self._pop_locked(job_id)
+
+
+class DayListingCache:
+    """Thread-safe cache of per-day recording listings, invalidated by directory mtime."""
+
+    def __init__(self):
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def get(self, day_path: str, mtime_ns: int):
+        """Return the cached listing if the directory is unchanged, else None."""
+        with self._lock:
+            entry = self._days.get(day_path)
+        if entry and entry[0] == mtime_ns:
+            return entry[1]
+        return None
+
+    # Directory mtimes are coarse: a file added in the same tick as the scan
+    # leaves mtime unchanged, so listings that recent are not trusted ("racily
+    # clean", as git calls it)
+    RACY_NS = 2_000_000_000
+
+    def put(self, day_path: str, mtime_ns: int, recordings: list) -> None:
+        if time.time_ns() - mtime_ns < self.RACY_NS:
+            return
+        with self._lock:
+            self._days[day_path] = (mtime_ns, recordings)
+
+    def prune(self, live_paths: set) -> None:
+        """Drop entries for day directories that no longer exist."""
+        with self._lock:
+            for day_path in [p for p in self._days if p not in live_paths]:
+                del self._days[day_path]
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return total
+
+
+class CompletedHlsCache:
+    """Thread-safe LRU of finished HLS job directories kept for repeat plays.
+
+    Bounded by entry count and total size on disk; evicted directories are removed.
+    Each kept directory holds a marker naming its source so the cache can be
+    rebuilt from disk on startup.
+    """
+
+    MARKER = ".source.json"
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._job_ids = set()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _pop_locked(self, input_key):
+        job_id, job_dir, size_bytes, _ = self._entries.pop(input_key)
+        self._job_ids.discard(job_id)
+        self._total_bytes -= size_bytes
+        return job_dir
+
+    def get(self, input_key, input_mtime_ns: int):
+        """Return the cached job id for input_key if still valid, else None."""
+        stale_dir = None
+        with self._lock:
+            entry = self._entries.get(input_key)
+            if not entry:
+                return None
+            job_id, job_dir, _, mtime_ns = entry
+            if mtime_ns == input_mtime_ns and os.path.isdir(job_dir):
+                self._entries.move_to_end(input_key)
+                return job_id
+            stale_dir = self._pop_locked(input_key)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+        return None
+
+    def holds(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._job_ids
+
+    def _insert_locked(self, input_key, job_id, job_dir, size_bytes, input_mtime_ns):
+        evicted = []
+        if input_key in self._entries:
+            evicted.append(self._pop_locked(input_key))
+        self._entries[input_key] = (job_id, job_dir, size_bytes, input_mtime_ns)
+        self._job_ids.add(job_id)
+        self._total_bytes += size_bytes
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+        ):
+            evicted.append(self._pop_locked(next(iter(self._entries))))
+        return evicted
+
+    def add(self, input_key, job_id: str, job_dir: str, input_mtime_ns: int) -> None:
+        try:
+            with open(os.path.join(job_dir, self.MARKER), "w") as f:
+                json.dump({"input": list(input_key), "mtime_ns": input_mtime_ns}, f)
+        except OSError as e:
+            logger.warning(f"Failed to write HLS cache marker in {job_dir}: {e}")
+        size_bytes = _dir_size(job_dir)
+        with self._lock:
+            evicted = self._insert_locked(
+                input_key, job_id, job_dir, size_bytes, input_mtime_ns
+            )
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def load(self, hls_path: str, orphan_age: float = 200) -> None:
+        """Re-index kept renditions under hls_path after a restart.
+
+        Marked directories are registered oldest first (evicting past the
+        limits); unmarked ones older than orphan_age seconds are leftovers of
+        jobs that never finished and are removed. Younger unmarked directories
+        may belong to another worker's running job and are left alone.
+        """
+        kept = []
+        orphans = []
+        now = time.time()
+        try:
+            with os.scandir(hls_path) as it:
+                for entry in it:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    try:
+                        with open(os.path.join(entry.path, self.MARKER)) as f:
+                            marker = json.load(f)
+                        input_key = tuple(marker["input"])
+                        kept.append(
+                            (
+                                entry.stat().st_mtime,
+                                input_key,
+                                entry.name,
+                                entry.path,
+                                marker["mtime_ns"],
+                            )
+                        )
+                    except (OSError, ValueError, KeyError, TypeError):
+                        try:
+                            if now - entry.stat().st_mtime > orphan_age:
+                                orphans.append(entry.path)
+                        except OSError:
+                            pass
+        except OSError as e:
+            logger.warning(f"Failed to scan HLS path {hls_path}: {e}")
+            return
+
+        evicted = []
+        kept.sort(key=itemgetter(0))
+        with self._lock:
+            for _, input_key, job_id, job_dir, input_mtime_ns in kept:
+                evicted.extend(
+                    self._insert_locked(
+                        input_key, job_id, job_dir, _dir_size(job_dir), input_mtime_ns
+                    )
+                )
+        for path in evicted + orphans:
+            shutil.rmtree(path, ignore_errors=True)
+        logger.info(
+            f"HLS cache: re-indexed {len(kept) - len(evicted)} renditions, "
+            f"removed {len(evicted) + len(orphans)} stale directories"
+        )
+
+
+class FileReadyWaiter:
+    """Block until files appear under a directory, driven by inotify events.
+
+    Falls back to polling when inotify (via watchdog) is not available.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+        self._events = {}
+        self._lock = threading.Lock()
+        self._observer = None
+
+    def start(self) -> None:
+        if InotifyObserver is None:
+            logger.info("inotify unavailable; falling back to polling for HLS files")
+            return
+        try:
+            observer = InotifyObserver()
+            observer.schedule(_ReadyEventHandler(self), self.root, recursive=True)
+            observer.daemon = True
+            observer.start()
+            self._observer = observer
+        except Exception as e:
+            logger.warning(f"Failed to start inotify watcher, polling instead: {e}")
+
+    def notify(self, path: str) -> None:
+        path = os.path.abspath(path)
+        with self._lock:
+            event = self._events.pop(path, None)
+        if event:
+            event.set()
+
+    def wait(self, path: str, timeout: float) -> bool:
+        """Wait up to timeout seconds for path to exist; return whether it does."""
+        path = os.path.abspath(path)
+        if os.path.exists(path):
+            return True
+        deadline = time.monotonic() + timeout
+        if self._observer is None or not self._observer.is_alive():
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                if os.path.exists(path):
+                    return True
+            return False
+
+        with self._lock:
+            event = self._events.setdefault(path, threading.Event())
+        # Re-check after registering so a file created in between is not missed;
+        # wake periodically in case the watch on a fresh job dir raced the write.
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    if self._events.get(path) is event:
+                        self._events.pop(path, None)
+                return False
+            event.wait(min(remaining, 1.0))
+        return True
+
+
+class _ReadyEventHandler(FileSystemEventHandler):
+    """Forward close-after-write and rename-into-place events to the waiter."""
+
+    def __init__(self, waiter: FileReadyWaiter):
+        self._waiter = waiter
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._waiter.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._waiter.notify(event.dest_path)
 
 
 """Initialize configuration and shared state instances."""
@@ -101,120 +466,175 @@ app.app_config = AppConfig()
 Path(app.app_config.hls_path).mkdir(parents=True, exist_ok=True)
 app.transcode_state = TranscodeState(app.app_config.max_concurrent_transcodes)
 app.hls_registry = HlsJobRegistry()
+app.day_cache = DayListingCache()
+app.hls_cache = CompletedHlsCache(
+    app.app_config.hls_cache_entries, app.app_config.hls_cache_max_bytes
+)
+app.hls_cache.load(app.app_config.hls_path)
+app.tree_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="tree")
+app.file_waiter = FileReadyWaiter(app.app_config.hls_path)
+app.file_waiter.start()
+
+# Canonical roots resolved once; request paths are validated against them lexically
+SAFE_HLS_ROOT = os.path.realpath(app.app_config.hls_path)
+SAFE_REC_ROOT = os.path.realpath(app.app_config.recordings_path)
 
 """Removed legacy direct MP4 streaming and caching helpers in favor of HLS."""
 
 
+# Pattern: Driveway_00_20250905173157.jpg/mp4
+_FILENAME_RE = re.compile(r"(.+)_(\d{2})_(\d{14})\.(jpg|mp4)$")
+
+
 def parse_filename(filename):
-    """Parse recording filename to extract metadata"""
-    # Pattern: Driveway_00_20250905173157.jpg/mp4
-    pattern = r"(.+)_(\d{2})_(\d{14})\.(jpg|mp4)"
-    match = re.match(pattern, filename)
+    """Parse recording filename into (base_name, timestamp_str, extension).
+
+    Returns raw strings only; no datetime is built per file.
+    """
+    if not filename.endswith((".jpg", ".mp4")):
+        return None
+    match = _FILENAME_RE.match(filename)
     if match:
-        camera_name, sequence, timestamp_str, extension = match.groups()
-        timestamp = datetime.strptime(timestamp_str, "%Y%m%d%H%M%S")
-        return {
-            "camera_name": camera_name,
-            "sequence": sequence,
-            "timestamp": timestamp,
-            "extension": extension,
-            "base_name": f"{camera_name}_{sequence}_{timestamp_str}",
-        }
+        return filename[:-4], match.group(3), match.group(4)
     return None
 
 
-def get_file_tree():
-    """Build file tree structure from recordings directory"""
-    tree = {}
-    # Prepare a top-level "Today" node aggregating all cameras' recordings for today's date
-    today = datetime.today()
-    today_year = f"{today.year:04d}"
-    today_month = f"{today.month:02d}"
-    today_day = f"{today.day:02d}"
-    tree["Today"] = []
-    recordings_path = Path(app.app_config.recordings_path)
-
-    if not recordings_path.exists():
-        return tree
-
-    for camera_dir in recordings_path.iterdir():
-        if not camera_dir.is_dir():
+def _subdirs(path):
+    """Yield (name, path) for each subdirectory of path using a single scandir."""
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    yield entry.name, entry.path
+    except OSError:
+        return
+
+
+def _scan_day(day_path, rel_path):
+    """List recordings in one day directory from a single scandir pass.
+
+    Returns (recordings, complete). With VALIDATE_SIZES enabled, empty files are
+    skipped as still being written and complete is False so the listing is not
+    cached; otherwise no per-file stat() is made.
+    """
+    validate_sizes = app.app_config.validate_sizes
+    files_by_base = {}
+    with os.scandir(day_path) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            parsed = parse_filename(entry.name)
+            if parsed:
+                base_name, _, extension = parsed
+                if base_name not in files_by_base:
+                    files_by_base[base_name] = {"jpg": None, "mp4": None}
+                files_by_base[base_name][extension] = entry
+
+    # Convert to list of recordings - prioritize MP4 files, show thumbnail if available
+    recordings = []
+    complete = True
+    for base_name, files in files_by_base.items():
+        mp4_entry = files["mp4"]
+        if not mp4_entry:  # Only need MP4 file
             continue
+        if validate_sizes and mp4_entry.stat().st_size <= 0:
+            complete = False
+            continue
+        # Thumbnail was seen in the same scandir pass; optionally check it is non-empty
+        thumbnail = None
+        jpg_entry = files["jpg"]
+        if jpg_entry:
+            if not validate_sizes or jpg_entry.stat().st_size > 0:
+                thumbnail = jpg_entry.name
+            else:
+                complete = False
+        recordings.append(
+            {
+                "base_name": base_name,
+                "thumbnail": thumbnail,  # Can be None
+                "video": mp4_entry.name,
+                "path": rel_path,
+            }
+        )
 
-        camera_name = camera_dir.name
-        tree[camera_name] = {}
+    # Sort by timestamp
+    recordings.sort(key=lambda x: x["base_name"])
+    return recordings, complete
 
-        for year_dir in camera_dir.iterdir():
-            if not year_dir.is_dir():
-                continue
 
-            year = year_dir.name
-            tree[camera_name][year] = {}
+def _as_int(name):
+    return int(name) if name.isdecimal() else None
 
-            for month_dir in year_dir.iterdir():
-                if not month_dir.is_dir():
-                    continue
 
-                month = month_dir.name
-                tree[camera_name][year][month] = {}
+def _walk_camera(camera_name, camera_path):
+    """Walk one camera's year/month/day folders.
 
-                for day_dir in month_dir.iterdir():
-                    if not day_dir.is_dir():
+    Returns a flat list of (camera, year, month, day, day_path, recordings) rows
+    in walk order, so rows sharing a camera/year/month prefix are contiguous.
+    """
+    rows = []
+    for year, year_path in _subdirs(camera_path):
+        for month, month_path in _subdirs(year_path):
+            for day, day_path in _subdirs(month_path):
+                try:
+                    mtime_ns = os.stat(day_path).st_mtime_ns
+                except OSError:
+                    continue
+                recordings = app.day_cache.get(day_path, mtime_ns)
+                if recordings is None:
+                    try:
+                        recordings, complete = _scan_day(
+                            day_path, f"{camera_name}/{year}/{month}/{day}"
+                        )
+                    except OSError:
                         continue
+                    if complete:
+                        app.day_cache.put(day_path, mtime_ns, recordings)
+                rows.append((camera_name, year, month, day, day_path, recordings))
+    return rows
 
-                    day = day_dir.name
-                    recordings = []
-
-                    # Group files by base name (same recording)
-                    files_by_base = {}
-                    for file_path in day_dir.iterdir():
-                        if file_path.is_file():
-                            parsed = parse_filename(file_path.name)
-                            if parsed:
-                                base_name = parsed["base_name"]
-                                if base_name not in files_by_base:
-                                    files_by_base[base_name] = {
-                                        "jpg": None,
-                                        "mp4": None,
-                                    }
-                                files_by_base[base_name][
-                                    parsed["extension"]
-                                ] = file_path.name
-
-                    # Convert to list of recordings - prioritize MP4 files, show thumbnail if available
-                    for base_name, files in files_by_base.items():
-                        if files["mp4"]:  # Only need MP4 file
-                            mp4_path = day_dir / files["mp4"]
-                            if mp4_path.exists() and mp4_path.stat().st_size > 0:
-                                # Check if JPG exists and is valid
-                                thumbnail = None
-                                if files["jpg"]:
-                                    jpg_path = day_dir / files["jpg"]
-                                    if (
-                                        jpg_path.exists()
-                                        and jpg_path.stat().st_size > 0
-                                    ):
-                                        thumbnail = files["jpg"]
-
-                                recording_entry = {
-                                    "base_name": base_name,
-                                    "thumbnail": thumbnail,  # Can be None
-                                    "video": files["mp4"],
-                                    "path": f"{camera_name}/{year}/{month}/{day}",
-                                }
-                                recordings.append(recording_entry)
-                                # If this recording is from today, also add it under the top-level Today bucket
-                                if (
-                                    year == today_year
-                                    and month == today_month
-                                    and day == today_day
-                                ):
-                                    tree["Today"].append(recording_entry)
-
-                    # Sort by timestamp
-                    recordings.sort(key=lambda x: x["base_name"])
-                    tree[camera_name][year][month][day] = recordings
 
+def _nest_rows(rows):
+    """Group contiguous day rows into {camera: {year: {month: {day: recordings}}}}."""
+    tree = {}
+    for camera_name, camera_rows in groupby(rows, key=itemgetter(0)):
+        years = tree[camera_name] = {}
+        for year, year_rows in groupby(camera_rows, key=itemgetter(1)):
+            months = years[year] = {}
+            for month, month_rows in groupby(year_rows, key=itemgetter(2)):
+                months[month] = {row[3]: row[5] for row in month_rows}
+    return tree
+
+
+def get_file_tree():
+    """Build file tree structure from recordings directory"""
+    # Prepare a top-level "Today" node aggregating all cameras' recordings for today's date
+    tree = {"Today": []}
+    recordings_path = app.app_config.recordings_path
+
+    if not os.path.isdir(recordings_path):
+        return tree
+
+    # Walk cameras concurrently; scandir/stat release the GIL so IO overlaps
+    futures = [
+        app.tree_executor.submit(_walk_camera, camera_name, camera_path)
+        for camera_name, camera_path in _subdirs(recordings_path)
+    ]
+    rows = [row for future in futures for row in future.result()]
+    # Clients render nodes in key order; sort here once so the serializer needn't
+    rows.sort(key=itemgetter(0, 1, 2, 3))
+    app.day_cache.prune({row[4] for row in rows})
+
+    today = datetime.now()
+    tree["Today"] = [
+        recording
+        for _, year, month, day, _, recordings in rows
+        if _as_int(day) == today.day
+        and _as_int(month) == today.month
+        and _as_int(year) == today.year
+        for recording in recordings
+    ]
+    tree.update(_nest_rows(rows))
     return tree
 
 
@@ -306,66 +726,350 @@ def favicon():
 @app.route("/api/tree")
 def api_tree():
     """API endpoint to get file tree structure"""
-    return jsonify(get_file_tree())
+    tree = get_file_tree()
+    if orjson is None:
+        return jsonify(tree)
+    return Response(
+        orjson.dumps(tree, option=orjson.OPT_NON_STR_KEYS), mimetype="application/json"
+    )
 
 
-def get_range_requests(file_size):
-    """Parse Range header and return start, end positions"""
-    range_header = request.headers.get("Range", None)
-    if not range_header:
-        return None, None
+OFFLOAD_MIMETYPES = {
+    "mp4": "video/mp4",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+def send_media(fs_path, mimetype, etag=True, max_age=None):
+    """Send a file with Range, ETag and If-Modified-Since handled by Werkzeug.
+
+    The body is passed to the server's wsgi.file_wrapper, which servers such as
+    gunicorn turn into sendfile(2). Werkzeug serves 206 responses through its
+    own range iterator, which cannot seek the server's wrapper and reads up to
+    the offset instead; under gunicorn the file is seeked to the range start
+    and handed back to the wrapper, which stops at Content-Length.
+    """
+    resp = send_file(
+        fs_path, mimetype=mimetype, conditional=True, etag=etag, max_age=max_age
+    )
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if (
+        resp.status_code == 206
+        and file_wrapper
+        and request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")
+    ):
+        resp.close()
+        f = open(fs_path, "rb")
+        f.seek(resp.content_range.start)
+        resp.response = file_wrapper(f, 1024 * 1024)
+        resp.direct_passthrough = True
+    return resp
 
-    # Parse range header like "bytes=0-1023"
-    match = re.search(r"bytes=(\d+)-(\d*)", range_header)
-    if match:
-        byte_start = int(match.group(1))
-        byte_end = int(match.group(2)) if match.group(2) else file_size - 1
-        return byte_start, min(byte_end, file_size - 1)
 
-    return None, None
+def offload_response(fs_path, mimetype):
+    """Hand the file off to a fronting proxy when the deployment configures one.
+
+    nginx: ACCEL_MAPPING maps filesystem prefixes to internal locations and an
+    empty response with ``X-Accel-Redirect`` is returned. Apache/lighttpd:
+    SENDFILE_HEADER names the header (e.g. ``X-Sendfile``) carrying the path.
+    Returns None when no proxy offload is configured.
+    """
+    config = app.app_config
+    if not config.accel_mapping and not config.sendfile_header:
+        return None
+
+    real_path = os.path.realpath(fs_path)
+    if config.accel_mapping:
+        for fs_prefix, uri_prefix in config.accel_mapping:
+            if real_path.startswith(fs_prefix + "/"):
+                relpath = real_path[len(fs_prefix) + 1 :]
+                resp = Response(mimetype=mimetype)
+                resp.headers["X-Accel-Redirect"] = uri_prefix + "/" + quote(relpath)
+                return resp
+        return None
+
+    resp = Response(mimetype=mimetype)
+    resp.headers[config.sendfile_header] = real_path
+    return resp
+
+
+@functools.lru_cache(maxsize=None)
+def _tool(name):
+    """Resolve an external tool to an absolute path once per process.
+
+    Saves a PATH search on every ffmpeg/ffprobe launch.
+    """
+    return shutil.which(name) or name
+
+
+@functools.lru_cache(maxsize=256)
+def _probe_file_cached(path, mtime_ns, size):
+    """Run one ffprobe for stream codecs and duration; cached per file version.
+
+    Raises on any probe failure so that lru_cache does not memoize it.
+    """
+    info = {"v_codec": "", "v_pix": "", "a_codec": "", "duration": None}
+    result = subprocess.run(
+        [
+            _tool("ffprobe"),
+            "-v",
+            "error",
+            "-show_entries",
+            "stream=index,codec_type,codec_name,pix_fmt:format=duration",
+            "-of",
+            "json",
+            path,
+        ],
+        capture_output=True,
+        text=True,
+        timeout=5,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe exited with {result.returncode}")
+    data = json.loads(result.stdout)
+
+    streams = data.get("streams") or []
+    v = next((st for st in streams if st.get("codec_type") == "video"), None)
+    a = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    info["v_codec"] = (v.get("codec_name") if v else "") or ""
+    info["v_pix"] = (v.get("pix_fmt") if v else "") or ""
+    info["a_codec"] = (a.get("codec_name") if a else "") or ""
+    try:
+        duration = float((data.get("format") or {}).get("duration"))
+        info["duration"] = duration if duration > 0 else None
+    except (TypeError, ValueError):
+        info["duration"] = None
+    return info
+
+
+def probe_file(path):
+    """Return codec/pix_fmt/duration metadata for a media file.
+
+    Successful results are memoized by (path, mtime, size) so repeated plays of
+    the same recording skip the ffprobe subprocess entirely; failures are not
+    cached and the next request probes again.
+    """
+    try:
+        st = os.stat(path)
+        return dict(_probe_file_cached(path, st.st_mtime_ns, st.st_size))
+    except Exception as e:
+        logger.debug(f"ffprobe failed for {path}: {e}")
+        return {"v_codec": "", "v_pix": "", "a_codec": "", "duration": None}
+
+
+SEGMENT_SECONDS = 2
+
+
+def build_vod_playlist(total_duration, segment_time=SEGMENT_SECONDS):
+    """Render a complete fMP4 VOD playlist for fixed-length segments."""
+    num_full = int(total_duration // segment_time)
+    remainder = total_duration - num_full * segment_time
+    parts = [
+        "#EXTM3U\n"
+        "#EXT-X-VERSION:7\n"
+        f"#EXT-X-TARGETDURATION:{segment_time}\n"
+        "#EXT-X-MEDIA-SEQUENCE:0\n"
+        "#EXT-X-PLAYLIST-TYPE:VOD\n"
+        "#EXT-X-INDEPENDENT-SEGMENTS\n"
+        '#EXT-X-MAP:URI="init.mp4"\n'
+    ]
+    full_extinf = f"#EXTINF:{segment_time:.3f},\n"
+    parts.extend(f"{full_extinf}seg_{i:05d}.m4s\n" for i in range(num_full))
+    if remainder > 0.01:
+        parts.append(f"#EXTINF:{remainder:.3f},\nseg_{num_full:05d}.m4s\n")
+    parts.append("#EXT-X-ENDLIST\n")
+    return "".join(parts)
+
+
+HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi", "h264_videotoolbox")
+
+
+def video_encoder_args(encoder, fast_mode=True):
+    """Return (input_args, output_args) for transcoding video with encoder."""
+    width = 720 if fast_mode else 1280
+    scale = f"scale={width}:-2"
+    gop = [
+        "-g",
+        "48",
+        "-keyint_min",
+        "48",
+        "-r",
+        "24",
+        "-force_key_frames",
+        f"expr:gte(t,n_forced*{SEGMENT_SECONDS})",
+    ]
+    if encoder == "h264_nvenc":
+        return [], [
+            "-c:v",
+            "h264_nvenc",
+            "-preset",
+            "p4" if fast_mode else "p6",
+            "-tune",
+            "ll",
+            "-rc",
+            "vbr",
+            "-cq",
+            "23",
+            "-profile:v",
+            "baseline",
+            "-pix_fmt",
+            "yuv420p",
+            "-vf",
+            scale,
+        ] + gop
+    if encoder == "h264_qsv":
+        return [], [
+            "-c:v",
+            "h264_qsv",
+            "-preset",
+            "veryfast" if fast_mode else "medium",
+            "-profile:v",
+            "baseline",
+            "-vf",
+            f"{scale},format=nv12",
+        ] + gop
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", app.app_config.vaapi_device], [
+            "-vf",
+            f"format=nv12,hwupload,scale_vaapi=w={width}:h=-2",
+            "-c:v",
+            "h264_vaapi",
+            "-profile:v",
+            "constrained_baseline",
+        ] + gop
+    if encoder == "h264_videotoolbox":
+        return [], [
+            "-c:v",
+            "h264_videotoolbox",
+            "-profile:v",
+            "baseline",
+            "-pix_fmt",
+            "yuv420p",
+            "-vf",
+            scale,
+        ] + gop
+    return [], [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "veryfast" if fast_mode else "medium",
+        "-pix_fmt",
+        "yuv420p",
+        "-profile:v",
+        "baseline",
+        "-level",
+        "3.0",
+        "-vf",
+        scale,
+        "-sc_threshold",
+        "0",
+    ] + gop
+
+
+def _encoder_works(encoder):
+    """Encode a few synthetic frames to confirm the encoder and its device work."""
+    input_args, output_args = video_encoder_args(encoder)
+    try:
+        result = subprocess.run(
+            [_tool("ffmpeg"), "-hide_banner", "-loglevel", "error"]
+            + input_args
+            + ["-f", "lavfi", "-i", "color=c=black:s=320x240:d=0.5"]
+            + output_args
+            + ["-frames:v", "5", "-f", "null", "-"],
+            capture_output=True,
+            timeout=15,
+        )
+        return result.returncode == 0
+    except Exception:
+        return False
+
+
+_encoder_lock = threading.Lock()
+
+
+def select_video_encoder():
+    """Pick the video encoder for transcodes once per process.
+
+    Detection is warmed in the background at startup; callers arriving while it
+    runs wait for that result instead of probing again.
+    """
+    with _encoder_lock:
+        return _detect_video_encoder()
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_video_encoder():
+    """Return the first working encoder allowed by HW_ENCODER, else libx264.
+
+    Listing in ``ffmpeg -encoders`` only means support was compiled in, so each
+    hardware candidate is verified with a short test encode before use.
+    """
+    wanted = app.app_config.hw_encoder
+    if wanted in ("none", "libx264", ""):
+        return "libx264"
+    candidates = HW_ENCODERS if wanted == "auto" else (wanted,)
+    try:
+        result = subprocess.run(
+            [_tool("ffmpeg"), "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=5,
+        )
+        available = result.stdout if result.returncode == 0 else ""
+    except Exception:
+        available = ""
+    for encoder in candidates:
+        if re.search(rf"\s{re.escape(encoder)}\s", available) and _encoder_works(
+            encoder
+        ):
+            logger.info(f"Using hardware video encoder: {encoder}")
+            return encoder
+    logger.info("No usable hardware video encoder; using libx264")
+    return "libx264"
 
 
 def start_hls_vod(input_path, fast_mode=True, playlist_type="event"):
     """Create HLS playlist and segments; return subpath. playlist_type: 'event' (streaming) or 'vod' (accurate)."""
-    if not app.transcode_state.can_start():
-        return None
     job_id = uuid.uuid4().hex
     job_dir = os.path.join(app.app_config.hls_path, job_id)
-    Path(job_dir).mkdir(parents=True, exist_ok=True)
+    input_key = (os.path.realpath(input_path), fast_mode, playlist_type)
+    # Replay a finished rendition straight from disk when one is cached
+    input_mtime_ns = os.stat(input_path).st_mtime_ns
+    cached_id = app.hls_cache.get(input_key, input_mtime_ns)
+    if cached_id:
+        logger.debug(f"Serving cached HLS job {cached_id} for: {input_path}")
+        return cached_id, cached_id + "/index.m3u8"
+    # Settle the encoder before reserving, so joiners never wait on detection
+    encoder = select_video_encoder()
+    # Reuse a running job for the same recording and settings instead of spawning another ffmpeg
+    # Only hand out a shared job once its ffmpeg is running; if the owner gave up
+    # (no slot, spawn failure) reserve again so this request can start its own
+    for _ in range(3):
+        existing_id = app.hls_registry.reserve(input_key, job_id, job_dir)
+        if not existing_id:
+            break
+        if app.hls_registry.wait_started(existing_id, timeout=10):
+            logger.debug(f"Reusing HLS job {existing_id} for: {input_path}")
+            return existing_id, existing_id + "/index.m3u8"
+        app.hls_registry.release(existing_id)
+    else:
+        return None
+    if not app.transcode_state.can_start():
+        app.hls_registry.remove(job_id)
+        return None
+    try:
+        Path(job_dir).mkdir(parents=True, exist_ok=True)
+    except Exception:
+        app.hls_registry.remove(job_id)
+        raise
 
     # Probe input to decide copy-vs-transcode per stream
-    def probe_stream(select):
-        try:
-            result = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-select_streams",
-                    select,
-                    "-show_entries",
-                    "stream=codec_name,pix_fmt",
-                    "-of",
-                    "json",
-                    input_path,
-                ],
-                capture_output=True,
-                text=True,
-                timeout=5,
-            )
-            if result.returncode != 0:
-                return None
-            data = json.loads(result.stdout)
-            streams = data.get("streams") or []
-            return streams[0] if streams else None
-        except Exception:
-            return None
-
-    v = probe_stream("v:0")
-    a = probe_stream("a:0")
-    v_codec = (v.get("codec_name") if v else "") or ""
-    v_pix = (v.get("pix_fmt") if v else "") or ""
-    a_codec = (a.get("codec_name") if a else "") or ""
+    info = probe_file(input_path)
+    v_codec = info["v_codec"]
+    v_pix = info["v_pix"]
+    a_codec = info["a_codec"]
 
     can_copy_video = v_codec.lower() == "h264" and v_pix.lower() in (
         "yuv420p",
@@ -374,46 +1078,39 @@ def start_hls_vod(input_path, fast_mode=True, playlist_type="event"):
     can_copy_audio = a_codec.lower() == "aac"
 
     # CMAF/fMP4 HLS for broad compatibility; choose codecs based on probe
-    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-fflags", "+genpts", "-i", input_path]
-
     if can_copy_video:
-        cmd += ["-c:v", "copy"]
+        input_args, video_args = [], ["-c:v", "copy"]
     else:
-        cmd += [
-            "-c:v",
-            "libx264",
-            "-preset",
-            "veryfast" if fast_mode else "medium",
-            "-pix_fmt",
-            "yuv420p",
-            "-profile:v",
-            "baseline",
-            "-level",
-            "3.0",
-            "-vf",
-            "scale=720:-2" if fast_mode else "scale=1280:-2",
-            "-g",
-            "48",
-            "-sc_threshold",
-            "0",
-            "-keyint_min",
-            "48",
-            "-r",
-            "24",
-        ]
+        input_args, video_args = video_encoder_args(encoder, fast_mode)
+    cmd = [_tool("ffmpeg"), "-y", "-loglevel", "error", "-fflags", "+genpts"]
+    cmd += input_args + ["-i", input_path] + video_args
 
     if can_copy_audio:
         cmd += ["-c:a", "copy"]
     else:
         cmd += ["-c:a", "aac", "-b:a", "96k" if fast_mode else "128k"]
 
-    # We'll have ffmpeg write to an internal playlist path while we publish a static VOD playlist
-    internal_playlist = os.path.join(job_dir, "internal.m3u8")
+    # Publish a static VOD playlist up front when segment boundaries are known:
+    # re-encodes force a keyframe every SEGMENT_SECONDS, so every segment but the
+    # last is exactly that long. Copied video splits on the source's keyframes,
+    # so ffmpeg's own playlist is served instead to keep durations accurate.
+    published_playlist = os.path.join(job_dir, "index.m3u8")
+    total_duration = info["duration"]
+    prepublished = False
+    if not can_copy_video and total_duration:
+        try:
+            with open(published_playlist, "w") as f:
+                f.write(build_vod_playlist(total_duration))
+            prepublished = True
+        except Exception:
+            prepublished = False
+
+    # ffmpeg writes to an internal playlist when we published our own
     cmd += [
         "-f",
         "hls",
         "-hls_time",
-        "2",
+        str(SEGMENT_SECONDS),
         "-hls_list_size",
         "0",
         "-hls_playlist_type",
@@ -428,72 +1125,30 @@ def start_hls_vod(input_path, fast_mode=True, playlist_type="event"):
         os.path.join(job_dir, "seg_%05d.m4s"),
         "-hls_fmp4_init_filename",
         "init.mp4",
-        internal_playlist,
+        (
+            os.path.join(job_dir, "internal.m3u8")
+            if prepublished
+            else published_playlist
+        ),
     ]
-    # Pre-generate a static VOD playlist with accurate duration
-    published_playlist = os.path.join(job_dir, "index.m3u8")
-    segment_time = 2.0
-    total_duration = None
+
+    logger.debug(f"Starting HLS VOD job {job_id} for: {input_path}")
+    if not app.transcode_state.try_acquire():
+        app.hls_registry.remove(job_id)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return None
     try:
-        r = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-show_entries",
-                "format=duration",
-                "-of",
-                "default=nk=1:nw=1",
-                input_path,
-            ],
-            capture_output=True,
-            text=True,
-            timeout=5,
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
-        if r.returncode == 0:
-            ds = (r.stdout or "").strip()
-            if ds:
-                total_duration = float(ds)
     except Exception:
-        total_duration = None
-
-    if total_duration and total_duration > 0:
-        num_full = int(total_duration // segment_time)
-        remainder = total_duration - (num_full * segment_time)
-        segment_count = num_full + (1 if remainder > 0.01 else 0)
-        target_duration = int(
-            math.ceil(max(segment_time, remainder if remainder > 0 else segment_time))
-        )
-        lines = [
-            "#EXTM3U",
-            "#EXT-X-VERSION:7",
-            f"#EXT-X-TARGETDURATION:{target_duration}",
-            "#EXT-X-MEDIA-SEQUENCE:0",
-            "#EXT-X-PLAYLIST-TYPE:VOD",
-            "#EXT-X-INDEPENDENT-SEGMENTS",
-            '#EXT-X-MAP:URI="init.mp4"',
-        ]
-        for i in range(segment_count):
-            dur = (
-                segment_time
-                if i < num_full
-                else (remainder if remainder > 0.01 else segment_time)
-            )
-            lines.append(f"#EXTINF:{dur:.3f},")
-            lines.append(f"seg_{i:05d}.m4s")
-        lines.append("#EXT-X-ENDLIST")
-        try:
-            with open(published_playlist, "w") as f:
-                f.write("\n".join(lines) + "\n")
-        except Exception:
-            pass
-
-    logger.debug(f"Starting HLS VOD job {job_id} for: {input_path}")
-    app.transcode_state.increment()
-    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        app.transcode_state.release()
+        app.hls_registry.remove(job_id)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
 
-    # Register job for later cleanup
-    app.hls_registry.register(job_id, proc, job_dir)
+    # Attach the process to the reserved job for later cleanup
+    app.hls_registry.attach(job_id, proc)
 
     def finalize_cleanup(p, job_id_param, job_dir_param):
         try:
@@ -506,23 +1161,20 @@ def start_hls_vod(input_path, fast_mode=True, playlist_type="event"):
                 p.kill()
                 p.wait()
         finally:
-            app.transcode_state.decrement()
-            # Remove ephemeral artifacts if still present
+            app.transcode_state.release()
             app.hls_registry.remove(job_id_param)
+            # Keep complete renditions for repeat plays; drop partial ones
             try:
-                if os.path.isdir(job_dir_param):
+                if p.returncode == 0 and os.path.isdir(job_dir_param):
+                    app.hls_cache.add(
+                        input_key, job_id_param, job_dir_param, input_mtime_ns
+                    )
+                elif os.path.isdir(job_dir_param):
                     shutil.rmtree(job_dir_param, ignore_errors=True)
             except Exception:
                 pass
 
-    # Wait for init.mp4 and first segment to exist for fast start
-    init_path = os.path.join(job_dir, "init.mp4")
-    first_seg = os.path.join(job_dir, "seg_00000.m4s")
-    for _ in range(400):  # up to ~20s
-        if os.path.exists(init_path) and os.path.exists(first_seg):
-            break
-        time.sleep(0.05)
-
+    # Return immediately; serve_file blocks on init.mp4/segments until complete
     threading.Thread(
         target=finalize_cleanup, args=(proc, job_id, job_dir), daemon=True
     ).start()
@@ -531,13 +1183,11 @@ def start_hls_vod(input_path, fast_mode=True, playlist_type="event"):
 
 @app.route("/api/hls/<path:file_path>")
 def api_hls(file_path):
-    full_path = os.path.join(app.app_config.recordings_path, file_path)
+    full_path = _safe_join(SAFE_REC_ROOT, file_path)
+    if not full_path:
+        abort(403)
     if not os.path.exists(full_path):
         abort(404)
-    if not os.path.abspath(full_path).startswith(
-        os.path.abspath(app.app_config.recordings_path)
-    ):
-        abort(403)
     fast_mode = request.args.get("quality", "fast") == "fast"
     # Fast start with event playlist
     playlist_type = "event"
@@ -545,40 +1195,9 @@ def api_hls(file_path):
     if not job_and_subpath:
         return jsonify({"error": "HLS queue full"}), 503
     job_id, subpath = job_and_subpath
-    # Briefly wait for playlist file to appear to avoid immediate 404s when the player requests it
-    playlist_fs_path = os.path.join(app.app_config.hls_path, subpath)
-    # Wait briefly for initial playlist to appear; do not wait for ENDLIST
-    for _ in range(200):  # up to ~10s
-        if os.path.exists(playlist_fs_path):
-            break
-        time.sleep(0.05)
 
-    # Probe accurate duration and include it in the response
-    duration_sec = None
-    try:
-        result = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-select_streams",
-                "v:0",
-                "-show_entries",
-                "format=duration",
-                "-of",
-                "default=nk=1:nw=1",
-                full_path,
-            ],
-            capture_output=True,
-            text=True,
-            timeout=5,
-        )
-        if result.returncode == 0:
-            duration_str = (result.stdout or "").strip()
-            if duration_str:
-                duration_sec = float(duration_str)
-    except Exception:
-        duration_sec = None
+    # Duration comes from the cached probe performed when the job started
+    duration_sec = probe_file(full_path)["duration"]
 
     return jsonify(
         {"playlist": f"/api/files/{subpath}", "duration": duration_sec, "job": job_id}
@@ -588,9 +1207,9 @@ def api_hls(file_path):
 @app.route("/api/hls/<job_id>", methods=["DELETE"])
 def stop_hls_job(job_id):
     """Terminate an active HLS job and remove its temporary files."""
-    job = app.hls_registry.pop(job_id)
+    job = app.hls_registry.release(job_id)
     if not job:
-        # Nothing to do
+        # Unknown job, or other viewers are still using it
         return ("", 204)
     proc = job.get("proc")
     job_dir = job.get("dir")
@@ -605,109 +1224,138 @@ def stop_hls_job(job_id):
                 proc.wait()
     except Exception:
         pass
-    # Remove directory
+    # Remove directory unless ffmpeg finished cleanly; that rendition gets cached
     try:
-        if job_dir and os.path.isdir(job_dir):
+        finished = proc is not None and proc.returncode == 0
+        if (
+            not finished
+            and not app.hls_cache.holds(job_id)
+            and job_dir
+            and os.path.isdir(job_dir)
+        ):
             shutil.rmtree(job_dir, ignore_errors=True)
     except Exception:
         pass
     return ("", 204)
 
 
-@app.route("/api/files/<path:file_path>")
-def serve_file(file_path):
-    """Serve video and image files with proper range request support"""
-    full_path = os.path.join(app.app_config.recordings_path, file_path)
-    hls_path = os.path.join(app.app_config.hls_path, file_path)
-
-    # FIRST: Serve HLS assets under HLS_PATH (wait for segments if needed)
-    safe_hls_root = os.path.abspath(app.app_config.hls_path)
-    safe_hls_path = os.path.abspath(hls_path)
-    if safe_hls_path.startswith(safe_hls_root):
-        ext = file_path.lower().split(".")[-1]
-        if ext == "m3u8":
-            if not os.path.exists(safe_hls_path):
-                abort(404)
-            resp = send_file(safe_hls_path, mimetype="application/vnd.apple.mpegurl")
-            resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            resp.headers["Pragma"] = "no-cache"
-            resp.headers["Expires"] = "0"
-            return resp
-        if ext in ("m4s", "mp4", "ts"):
-            # Block until segment exists (for VOD playlist published ahead of segments)
-            for _ in range(1200):  # up to ~60s
-                if os.path.exists(safe_hls_path):
-                    break
-                time.sleep(0.05)
-            if not os.path.exists(safe_hls_path):
-                abort(404)
-            if ext == "m4s":
-                return send_file(safe_hls_path, mimetype="video/iso.segment")
-            if ext == "mp4":  # e.g., init.mp4
-                return send_file(safe_hls_path, mimetype="video/mp4")
-            if ext == "ts":
-                return send_file(safe_hls_path, mimetype="video/mp2t")
-            return send_file(safe_hls_path)
+def _safe_join(root, rel_path):
+    """Join rel_path under root; return None if it escapes root. No syscalls."""
+    path = os.path.normpath(os.path.join(root, rel_path))
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return path
 
-    if not os.path.exists(full_path):
+
+def _serve_hls_playlist(path, ext):
+    # The job is started without waiting; give the playlist a moment to appear
+    if not app.file_waiter.wait(path, 10):
         abort(404)
+    resp = send_file(path, mimetype="application/vnd.apple.mpegurl")
+    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    resp.headers["Pragma"] = "no-cache"
+    resp.headers["Expires"] = "0"
+    return resp
 
-    if not os.path.abspath(full_path).startswith(
-        os.path.abspath(app.app_config.recordings_path)
-    ):
-        abort(403)  # Prevent directory traversal
 
-    # (No duplicate secondary HLS serve block)
+def _serve_hls_segment(path, ext):
+    # Block until segment exists (for VOD playlist published ahead of segments)
+    deadline = time.monotonic() + 60
+    if not app.file_waiter.wait(path, 60):
+        abort(404)
+    job_dir, name = os.path.split(path)
+    # ffmpeg creates init.mp4 up front and fills it when the first segment is
+    # cut; segments are renamed into place (temp_file) only once complete
+    complete = name != "init.mp4" or app.file_waiter.wait(
+        os.path.join(job_dir, "seg_00000.m4s"), max(deadline - time.monotonic(), 0)
+    )
+    try:
+        if os.path.getsize(path) == 0:
+            abort(404)
+    except OSError:
+        abort(404)
+    mimetype = HLS_SEGMENT_MIMETYPES[ext]
+    if not complete:
+        # init.mp4 may still be partial; let clients revalidate instead of keeping it
+        resp = offload_response(path, mimetype) or send_media(
+            path, mimetype, max_age=0
+        )
+        resp.cache_control.no_cache = True
+        return resp
+    # Complete segments never change within a job (job ids are unique), so let
+    # browsers and proxies keep them; the ETag is derived from the job id and name
+    etag = f"{os.path.basename(job_dir)}-{name}"
+    resp = offload_response(path, mimetype)
+    if resp:
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = HLS_SEGMENT_MAX_AGE
+    else:
+        resp = send_media(path, mimetype, etag=etag, max_age=HLS_SEGMENT_MAX_AGE)
+    resp.cache_control.immutable = True
+    return resp
+
+
+HLS_SEGMENT_MAX_AGE = 31536000
+
+HLS_SEGMENT_MIMETYPES = {
+    "m4s": "video/iso.segment",
+    "mp4": "video/mp4",  # init.mp4
+    "ts": "video/mp2t",
+}
+
+HLS_HANDLERS = {
+    "m3u8": _serve_hls_playlist,
+    "m4s": _serve_hls_segment,
+    "mp4": _serve_hls_segment,
+    "ts": _serve_hls_segment,
+}
+
+# Recordings untouched for this long are complete and safe to cache
+RECORDING_SETTLED_SECONDS = 600
 
-    # Determine MIME type based on file extension
-    file_extension = file_path.lower().split(".")[-1]
+# HLS assets live at <32-hex job id>/<file>; anything else is a recording
+_HLS_ASSET_RE = re.compile(r"[0-9a-f]{32}/[^/]+$")
 
-    if file_extension == "m3u8":
-        full_hls_path = os.path.join(app.app_config.hls_path, file_path)
-        if not os.path.exists(full_hls_path):
+
+@app.route("/api/files/<path:file_path>")
+def serve_file(file_path):
+    """Serve video and image files with proper range request support"""
+    ext = file_path.rpartition(".")[2].lower()
+
+    # HLS job assets under HLS_PATH (wait for segments if needed)
+    if _HLS_ASSET_RE.match(file_path):
+        handler = HLS_HANDLERS.get(ext)
+        hls_path = _safe_join(SAFE_HLS_ROOT, file_path)
+        if not handler or not hls_path:
             abort(404)
-        resp = send_file(full_hls_path, mimetype="application/vnd.apple.mpegurl")
-        resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        resp.headers["Pragma"] = "no-cache"
-        resp.headers["Expires"] = "0"
-        return resp
-    if file_extension == "mp4":
-        # Serve original MP4 with Range support (no ffmpeg streaming here)
-        file_size = os.path.getsize(full_path)
-        byte_start, byte_end = get_range_requests(file_size)
-        if byte_start is None:
-            return send_file(full_path, mimetype="video/mp4")
-
-        def generate_original():
-            with open(full_path, "rb") as f:
-                f.seek(byte_start)
-                remaining = byte_end - byte_start + 1
-                while remaining:
-                    chunk_size = min(8192, remaining)
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    remaining -= len(chunk)
-                    yield chunk
-
-        response = Response(
-            generate_original(), 206, mimetype="video/mp4", direct_passthrough=True
-        )
-        response.headers.add("Accept-Ranges", "bytes")
-        response.headers.add(
-            "Content-Range", f"bytes {byte_start}-{byte_end}/{file_size}"
+        return handler(hls_path, ext)
+
+    full_path = _safe_join(SAFE_REC_ROOT, file_path)
+    if not full_path:
+        abort(403)  # Prevent directory traversal
+    try:
+        st = os.stat(full_path)
+    except (OSError, ValueError):  # missing, or an embedded NUL in the path
+        abort(404)
+    if st.st_size == 0:
+        # Still being written by the camera; don't hand out (and let clients
+        # cache) an empty body. The tree lists it only with VALIDATE_SIZES off.
+        abort(404)
+
+    # Only let browsers keep files the camera has finished writing
+    max_age = None
+    if time.time() - st.st_mtime > RECORDING_SETTLED_SECONDS:
+        max_age = app.app_config.send_file_max_age
+
+    mimetype = OFFLOAD_MIMETYPES.get(ext)
+    if mimetype:
+        # Let a fronting proxy stream the bytes when one is configured;
+        # otherwise Werkzeug handles Range and conditional requests
+        return offload_response(full_path, mimetype) or send_media(
+            full_path, mimetype, max_age=max_age
         )
-        response.headers.add("Content-Length", str(byte_end - byte_start + 1))
-        return response
-    if file_extension in ["m4s", "ts"]:
-        # Non-HLS-path segments requested directly (unlikely); just serve file
-        return send_file(full_path)
-    elif file_extension in ["jpg", "jpeg"]:
-        return send_file(full_path, mimetype="image/jpeg")
-    elif file_extension == "png":
-        return send_file(full_path, mimetype="image/png")
-    else:
-        return send_file(full_path)
+    return send_file(full_path, max_age=max_age)
 
 
 @app.route("/video-info/<path:file_path>")
@@ -751,5 +1399,12 @@ def transcode_status():
     return jsonify(app.transcode_state.snapshot())
 
 
+# Detect the video encoder now rather than inside the first transcode request
+threading.Thread(
+    target=select_video_encoder, name="encoder-detect", daemon=True
+).start()
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Development server only; production runs under gunicorn (gunicorn.conf.py)
+    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)
@@ -0,0 +1,17 @@
+"""Gunicorn settings for Reodash."""
+
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+
+# HLS players open several parallel connections and segment requests may block
+# until ffmpeg writes them, so serve with threads. HLS job state (dedup, slot
+# limits, cleanup) lives in-process, so keep a single worker by default.
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+timeout = 180
+keepalive = 5
+# Let the kernel copy file bodies (wsgi.file_wrapper -> sendfile(2))
+sendfile = True